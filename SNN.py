@@ -1,14 +1,95 @@
 from __future__ import print_function
 import torch
-import numpy as np
+import torch.nn.functional as F
 import utils.filters as filters
 import tables
 import os
+from typing import Tuple
+
+# Numba is optional, it is only required to run the forward pass with use_numba=True
+try:
+    from snn_numba import forward_step as numba_forward_step
+except ImportError:
+    numba_forward_step = None
+
+
+### Computations
+# The per-timestep computations are compiled with TorchScript to remove the Python overhead of the many small operations of a forward pass
+@torch.jit.script
+def _compute_trace(spiking_history, filter_T, indices):
+    # filter_T[indices] is the time-reversed filter aligned with the columns of the circular spiking history
+    return torch.matmul(spiking_history, filter_T[indices])
+
+
+@torch.jit.script
+def _forward_step(spiking_history, head: int, ff_gradient, ff_weights, ff_filter_T, ff_filter_T_past, fb_weights, fb_filter_T, fb_filter_T_past, filter_indices, bias,
+                  edge_index, learnable_idx, visible_idx, stochastic_idx, stochastic_local_idx, input_signal,
+                  memory_length: int, mode_train: bool, compute_logproba: bool, ff_sparse: bool) -> Tuple[int, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    # spiking_history is a circular buffer of size [(batch_size), n_neurons, memory_length] updated in place, the spikes of the last timestep are in column head.
+    # The optional leading batch dimension is carried by the ellipses, the weights are shared by all the trajectories of the batch.
+    ### Compute potential
+    fb_potential = torch.einsum('ik,...ik->...i', fb_weights, _compute_trace(spiking_history, fb_filter_T, filter_indices[head])[..., learnable_idx, :])
+    # In test mode the feedforward weights may be stored in a lower precision, the trace is cast to it before any gather,
+    # and the contributions are accumulated in the precision of the bias
+    if ff_sparse:
+        # For sparse topologies, the feedforward contributions are only computed along the edges and summed per post-synaptic neuron,
+        # so that the cost of a step scales with the number of synaptic connections rather than with n_learnable * n_neurons.
+        # The weights are gathered at every step since the learning rules update them in place between steps.
+        ff_trace = _compute_trace(spiking_history, ff_filter_T, filter_indices[head]).to(ff_weights.dtype)[..., edge_index[1], :]
+        ff_contributions = torch.sum(ff_weights[edge_index[0], edge_index[1]] * ff_trace, dim=-1, dtype=bias.dtype)
+        ff_potential = torch.zeros_like(fb_potential).index_add_(-1, edge_index[0], ff_contributions)
+    else:
+        # Otherwise, feedforward weights are zero outside of the topology, so a single contraction over the pre-synaptic neurons and the basis
+        # needs no masking and no [(batch_size), n_edges, n_basis] intermediate. The matrix product accumulates its sums in fp32, only its output is rounded
+        ff_potential = torch.einsum('ijk,...jk->...i', ff_weights, _compute_trace(spiking_history, ff_filter_T, filter_indices[head]).to(ff_weights.dtype)).to(bias.dtype)
+    potential = ff_potential + fb_potential + bias
+    # Spiking probabilities, computed once and shared by the sampling and gradients
+    sig = torch.sigmoid(potential)
+
+    ### Update spiking history
+    # The oldest timestep is overwritten by the current one
+    head = (head + 1) % memory_length
+    spiking_history[..., head] = 0.
+    spiking_history[..., visible_idx, head] = input_signal
+
+    # Hidden neurons, and output neurons during test, are sampled with a single call
+    if stochastic_idx.shape[0] > 0:
+        spiking_history[..., stochastic_idx, head] = torch.bernoulli(sig[..., stochastic_local_idx])
+
+    ### Compute log-probabilities
+    spikes = spiking_history[..., learnable_idx, head]
+    if compute_logproba:
+        # log(sigmoid(u)) = -softplus(-u) and log(1 - sigmoid(u)) = -softplus(u), which are stable without adding an epsilon
+        log_sig = - F.softplus(- potential)
+        log_1msig = - F.softplus(potential)
+        log_proba = spikes * log_sig + (1 - spikes) * log_1msig
+    else:
+        log_proba = torch.empty(0, device=bias.device)
+
+    ### Compute gradients
+    if mode_train:
+        bias_gradient = spikes - sig
+
+        # Traces of the past timesteps, the current one is aligned with the zero row of the past filters
+        ff_trace = _compute_trace(spiking_history, ff_filter_T_past, filter_indices[(head + memory_length - 1) % memory_length])
+        # Gradients are computed for each trajectory of the batch, by broadcasting rather than repeating the tensors.
+        # The feedforward gradient is only evaluated at the synaptic connections and written in place in its buffer, whose other entries are always zero
+        ff_gradient[..., edge_index[0], edge_index[1], :] = ff_trace[..., edge_index[1], :] * bias_gradient[..., edge_index[0]].unsqueeze(-1)
+
+        fb_gradient = _compute_trace(spiking_history, fb_filter_T_past, filter_indices[(head + memory_length - 1) % memory_length])[..., learnable_idx, :] \
+                      * bias_gradient.unsqueeze(-1)
+    else:
+        # Gradients are not needed during test, or when the caller only needs the spikes
+        bias_gradient = torch.empty(0, device=bias.device)
+        fb_gradient = torch.empty(0, device=bias.device)
+
+    return head, potential, log_proba, ff_gradient, fb_gradient, bias_gradient
 
 
 class SNNetwork(torch.nn.Module):
     def __init__(self, n_input_neurons, n_hidden_neurons, n_output_neurons, topology, n_basis_feedforward=1, feedforward_filter=filters.base_feedforward_filter,
-                 n_basis_feedback=1, feedback_filter=filters.base_feedback_filter, tau_ff=1, tau_fb=1, mu=1, weights_magnitude=0.1, task='supervised', mode='train', save_path=None):
+                 n_basis_feedback=1, feedback_filter=filters.base_feedback_filter, tau_ff=1, tau_fb=1, mu=1, weights_magnitude=0.1, task='supervised', mode='train', save_path=None, device='cpu',
+                 batch_size=None, use_numba=False, test_dtype=torch.float, record_length=0):
 
         super(SNNetwork, self).__init__()
         '''
@@ -25,7 +106,13 @@ class SNNetwork(torch.nn.Module):
         tau_ff, n_basis_feedforward: parameters of the feedforward filter
         tau_fb, n_basis_feedback: parameters of the feedback filter
         weights_magnitude: the weights are initialized following an uniform distribution between [-weights_magnitude, +weights_magnitude]
-        minibatch_size
+        device: the device on which the weights and the state of the network are kept, e.g. 'cpu' or 'cuda'
+        batch_size: number of trajectories simulated in parallel, the state of the network and the gradients then have a leading dimension of size batch_size.
+        If None, a single trajectory is simulated and there is no batch dimension
+        use_numba: if True, the forward pass of a single trajectory is run by the Numba implementation of snn_numba.py, batches use the PyTorch implementation.
+        Only available on CPU
+        test_dtype: dtype of the feedforward weights used in test mode, e.g. torch.bfloat16 to halve the memory traffic of the forward pass
+        record_length: number of timesteps of spikes recorded on the device, retrieved with pull_recording_buffer. No spikes are recorded if 0
         '''
 
         ### Network parameters
@@ -34,55 +121,75 @@ class SNNetwork(torch.nn.Module):
         self.n_output_neurons = n_output_neurons
         self.n_neurons = n_input_neurons + n_hidden_neurons + n_output_neurons
         self.weights_magnitude = weights_magnitude
+        self.device = torch.device(device)
+        # CUDA stream of the network, used by utils.distributed_utils.parallel_forward to overlap the kernels of several networks
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+
+        self.use_numba = use_numba
+        if self.use_numba:
+            assert numba_forward_step is not None, 'Numba is required to use use_numba=True'
+            assert self.device.type == 'cpu', 'The Numba forward pass is only available on CPU'
 
 
         ### Neurons indices
-        self.input_neurons = torch.LongTensor([i for i in range(self.n_input_neurons)])
-        self.hidden_neurons = torch.LongTensor([self.n_input_neurons + i for i in range(self.n_hidden_neurons)])
-        self.output_neurons = torch.LongTensor([self.n_input_neurons + self.n_hidden_neurons + i for i in range(self.n_output_neurons)])
+        # Indices are registered as buffers so that they live on the same device as the state of the network
+        self.register_buffer('input_neurons', torch.arange(self.n_input_neurons, dtype=torch.long, device=self.device), persistent=False)
+        self.register_buffer('hidden_neurons', torch.arange(self.n_input_neurons, self.n_input_neurons + self.n_hidden_neurons, dtype=torch.long, device=self.device),
+                             persistent=False)
+        self.register_buffer('output_neurons', torch.arange(self.n_input_neurons + self.n_hidden_neurons, self.n_neurons, dtype=torch.long, device=self.device),
+                             persistent=False)
 
 
         # In supervised mode, we avoid computations with unnecessary large matrices
         if task == 'supervised':
             self.n_learnable_neurons = n_hidden_neurons + n_output_neurons
             self.n_non_learnable_neurons = n_input_neurons
-            self.learnable_neurons = torch.cat((self.hidden_neurons, self.output_neurons))
+            self.register_buffer('learnable_neurons', torch.cat((self.hidden_neurons, self.output_neurons)), persistent=False)
         else:
             self.n_learnable_neurons = self.n_neurons
             self.n_non_learnable_neurons = 0
-            self.learnable_neurons = torch.cat((self.input_neurons, self.hidden_neurons, self.output_neurons))
+            self.register_buffer('learnable_neurons', torch.cat((self.input_neurons, self.hidden_neurons, self.output_neurons)), persistent=False)
 
-        self.non_learnable_neurons = torch.tensor([i for i in range(self.n_non_learnable_neurons)])
+        self.register_buffer('non_learnable_neurons', torch.arange(self.n_non_learnable_neurons, dtype=torch.long, device=self.device), persistent=False)
 
         assert (self.n_non_learnable_neurons + self.n_learnable_neurons) == self.n_neurons
 
 
-        # Set train mode, to avoid spurious computations of gradients during test
-        self.mode = mode
-        if self.mode == 'train':
-            self.visible_neurons = torch.cat((self.input_neurons, self.output_neurons))
-        elif self.mode == 'test':
-            self.visible_neurons = self.input_neurons
-        else:
-            print('Mode should be one of "train" or "test"')
-            raise AttributeError
+        # Buffers depending on the mode, they are set by set_mode once the weights are created
+        self.test_dtype = test_dtype
+        self.register_buffer('visible_neurons', None, persistent=False)
+        self.register_buffer('stochastic_neurons', None, persistent=False)
+        self.register_buffer('stochastic_local_neurons', None, persistent=False)
+        self.register_buffer('feedforward_weights_test', None, persistent=False)
 
 
         # Sanity checks
         assert self.n_learnable_neurons == topology.shape[0], 'The topology of the network should be of shape [n_learnable_neurons, n_neurons]'
         assert self.n_neurons == topology.shape[-1], 'The topology of the network should be of shape [n_learnable_neurons, n_neurons]'
-        topology[[i for i in range(self.n_learnable_neurons)], self.learnable_neurons] = 0
+        topology = topology.to(self.device)
+        topology[torch.arange(self.n_learnable_neurons, dtype=torch.long, device=self.device), self.learnable_neurons] = 0
 
 
         ### Feedforward weights
         self.n_basis_feedforward = n_basis_feedforward
+        # The synaptic connections are stored as an edge list: edge_index[0] are the post-synaptic (learnable) neurons, edge_index[1] the pre-synaptic neurons.
+        # The feedforward potential, the feedforward gradients and the initialization of the feedforward weights only involve those edges.
+        self.register_buffer('edge_index', torch.nonzero(topology).t().contiguous(), persistent=False)
+        # The forward pass relies on the feedforward weights being zero outside of the topology, weights set from outside are masked once with it
+        self.register_buffer('topology', topology.to(torch.float).unsqueeze(-1), persistent=False)
+        self.n_edges = self.edge_index.shape[-1]
+        # The feedforward potential of a single trajectory is computed along the edges if the topology is sparse enough for the gathers to be cheaper
+        # than a dense contraction, batches and denser topologies use the dense contraction
+        self.ff_sparse = self.n_edges * 8 <= self.n_learnable_neurons * self.n_neurons
+        # Edges are sorted by post-synaptic neuron, edges_ptr[i]:edges_ptr[i + 1] are the incoming connections of learnable neuron i (used by the Numba forward pass)
+        self.register_buffer('edges_ptr', torch.searchsorted(self.edge_index[0], torch.arange(self.n_learnable_neurons + 1, device=self.device)), persistent=False)
         # Creating the feedforward weights according to the topology.
         # Feedforward weights are a tensor of size [n_learnable_neurons, n_neurons, n_basis_feedforward] for which the block-diagonal elements are 0,
         # and otherwise feedforward_weights[i, j, :] ~ Unif[-weights_magnitude, +weights_magnitude] if topology[i, j] = 1
-        self.feedforward_mask = torch.tensor(np.kron(topology, np.ones([self.n_basis_feedforward]))
-                                             .reshape([self.n_learnable_neurons, self.n_neurons, self.n_basis_feedforward]), dtype=torch.float)
-        self.feedforward_weights = weights_magnitude * (torch.rand([self.n_learnable_neurons, self.n_neurons, self.n_basis_feedforward]) * 2 - 1) * self.feedforward_mask
-        self.feedforward_filter = feedforward_filter(tau_fb, self.n_basis_feedforward, mu)
+        # Weights are updated by the learning rules rather than by autograd, hence requires_grad=False
+        self.feedforward_weights = torch.nn.Parameter(torch.zeros([self.n_learnable_neurons, self.n_neurons, self.n_basis_feedforward], device=self.device), requires_grad=False)
+        self.feedforward_weights[self.edge_index[0], self.edge_index[1]] = torch.empty([self.n_edges, self.n_basis_feedforward], device=self.device).uniform_(-weights_magnitude, weights_magnitude)
+        self.register_buffer('feedforward_filter', feedforward_filter(tau_fb, self.n_basis_feedforward, mu).to(self.device))
         self.tau_ff = tau_ff
 
 
@@ -91,59 +198,107 @@ class SNNetwork(torch.nn.Module):
         # Creating the feedback weights.
         # Feedback weights are a tensor of size [n_neurons, n_basis_feedback],
         # for which learnable elements are initialized as ~ Unif[-weights_magnitude, +weights_magnitude],
-        self.feedback_weights = weights_magnitude * (torch.rand([self.n_learnable_neurons, self.n_basis_feedback]) * 2 - 1)
-        self.feedback_filter = feedback_filter(tau_fb, self.n_basis_feedback, mu)
+        self.feedback_weights = torch.nn.Parameter(torch.empty([self.n_learnable_neurons, self.n_basis_feedback], device=self.device).uniform_(-weights_magnitude, weights_magnitude), requires_grad=False)
+        self.register_buffer('feedback_filter', feedback_filter(tau_fb, self.n_basis_feedback, mu).to(self.device))
         self.tau_fb = tau_fb
 
+        # Set train mode, to avoid spurious computations of gradients during test
+        self.set_mode(mode)
+
 
         ### Bias
-        self.bias = weights_magnitude * (torch.rand([self.n_learnable_neurons]) * 2 - 1)
+        self.bias = torch.nn.Parameter(torch.empty([self.n_learnable_neurons], device=self.device).uniform_(-weights_magnitude, weights_magnitude), requires_grad=False)
 
         # Number of timesteps to keep in memory
         self.memory_length = max(self.tau_ff, self.tau_fb)
 
-        ### State of the network
-        self.spiking_history = torch.zeros([self.n_neurons, 1])
-        self.potential = torch.zeros([self.n_learnable_neurons])
-        self.feedforward_potential = torch.zeros([self.n_learnable_neurons])
-        self.feedback_potential = torch.zeros([self.n_learnable_neurons])
-
-        ### Gradients
-        self.gradients = {'ff_weights': torch.zeros(self.feedforward_weights.shape), 'fb_weights': torch.zeros(self.feedback_weights.shape), 'bias': torch.zeros(self.bias.shape)}
+        ### Time-reversed filters
+        # The filters are constant, their transposes of size [memory_length, n_basis] are computed once.
+        # filter_indices[head, t] is the age of the spikes stored in column t of the spiking history when the last timestep is in column head,
+        # so that filter_T[filter_indices[head]] replaces flipping the history.
+        # The past filters are used for the gradients, and ignore the spikes of the current timestep (of age memory_length - 1).
+        self.register_buffer('ff_filter_T', torch.zeros([self.memory_length, self.n_basis_feedforward], device=self.device), persistent=False)
+        self.ff_filter_T[:min(self.memory_length, self.feedforward_filter.shape[-1])] = self.feedforward_filter[:, :self.memory_length].t()
+        self.register_buffer('ff_filter_T_past', self.ff_filter_T.clone(), persistent=False)
+        self.ff_filter_T_past[-1] = 0
+
+        self.register_buffer('fb_filter_T', torch.zeros([self.memory_length, self.n_basis_feedback], device=self.device), persistent=False)
+        self.fb_filter_T[:min(self.memory_length, self.feedback_filter.shape[-1])] = self.feedback_filter[:, :self.memory_length].t()
+        self.register_buffer('fb_filter_T_past', self.fb_filter_T.clone(), persistent=False)
+        self.fb_filter_T_past[-1] = 0
+
+        self.register_buffer('filter_indices', (torch.arange(self.memory_length, device=self.device).unsqueeze(1)
+                                                - torch.arange(self.memory_length, device=self.device).unsqueeze(0)) % self.memory_length, persistent=False)
+
+        ### State of the network and gradients
+        # The spiking history is a circular buffer, in which the spikes of the last timestep are stored in column head
+        self.register_buffer('spiking_history', None, persistent=False)
+        self.register_buffer('potential', None, persistent=False)
+        self.register_buffer('spike_record', None, persistent=False)
+        self.register_buffer('ff_gradient', torch.zeros(0, device=self.device), persistent=False)
+        self.record_length = record_length
+        self.register_buffer('feedforward_potential', torch.zeros([self.n_learnable_neurons], device=self.device), persistent=False)
+        self.register_buffer('feedback_potential', torch.zeros([self.n_learnable_neurons], device=self.device), persistent=False)
+        # gradients['ff_weights'] is the ff_gradient buffer itself, which is overwritten in place at each step (and zero outside of the topology):
+        # a caller keeping the gradients of a step beyond the next forward pass should clone them
+        self.gradients = {}
+        self.set_batch_size(batch_size)
 
         # Path to where the weights are saved, if None they will be saved in the current directory
         self.save_path = save_path
 
 
-    def forward(self, input_signal):
-
-        assert self.n_neurons == (len(self.input_neurons) + len(self.hidden_neurons) + len(self.output_neurons)), "The numbers of neurons don't match"
-        assert self.n_neurons == (len(self.learnable_neurons) + len(self.non_learnable_neurons)), "The numbers of neurons don't match"
+    # Weights are learned with the gradients computed in the forward pass, no autograd graph is needed
+    @torch.no_grad()
+    def forward(self, input_signal, compute_logproba=True, compute_gradients=True):
+        # If compute_logproba is False, e.g. when only the spikes are needed, the log-probabilities are not computed and an empty tensor is returned.
+        # If compute_gradients is False, the gradients are not computed in train mode either, and self.gradients keeps those of the last step that computed them
+        compute_gradients = compute_gradients and (self.mode == 'train')
+        # The feedforward gradient buffer is allocated by set_batch_size, it is only allocated here if the network was switched to train mode after
+        if compute_gradients and (self.ff_gradient.shape != self.spiking_history.shape[:-2] + self.feedforward_weights.shape):
+            self.ff_gradient = torch.zeros(self.spiking_history.shape[:-2] + self.feedforward_weights.shape, device=self.device)
 
+        if self.use_numba and self.batch_size is None:
+            log_proba = self.forward_numba(input_signal, compute_logproba, compute_gradients)
+        else:
+            # Kernels are queued asynchronously on the device, the copy of the input should not block them
+            input_signal = input_signal.to(self.device, non_blocking=True)
 
-        ### Compute potential
-        self.potential = self.compute_ff_potential() + self.compute_fb_potential() + self.bias
+            self.head, self.potential, log_proba, ff_gradient, fb_gradient, bias_gradient \
+                = _forward_step(self.spiking_history, self.head, self.ff_gradient, self.feedforward_weights if self.mode == 'train' else self.feedforward_weights_test,
+                                self.ff_filter_T, self.ff_filter_T_past, self.feedback_weights, self.fb_filter_T, self.fb_filter_T_past, self.filter_indices, self.bias,
+                                self.edge_index, self.learnable_neurons, self.visible_neurons, self.stochastic_neurons, self.stochastic_local_neurons, input_signal,
+                                self.memory_length, compute_gradients, compute_logproba, self.ff_sparse and (self.batch_size is None))
 
-        ### Update spiking history
-        self.spiking_history = self.update_spiking_history(input_signal)
+            if compute_gradients:
+                self.gradients = {'ff_weights': ff_gradient, 'fb_weights': fb_gradient, 'bias': bias_gradient}
 
-        ### Compute log-probabilities
-        # noinspection PyTypeChecker
-        log_proba = self.spiking_history[self.learnable_neurons, -1] * torch.log(1e-07 + torch.sigmoid(self.potential)) \
-                    + (1 - self.spiking_history[self.learnable_neurons, -1]) * torch.log(1. + 1e-07 - torch.sigmoid(self.potential))  # We add 1e-07 for numerical stability of the log
+        ### Record spikes
+        # Spikes are kept on the device and copied to the host at once by pull_recording_buffer
+        if self.record_length > 0:
+            self.spike_record[..., self.rec_head % self.record_length] = self.spiking_history[..., self.head]
+            self.rec_head += 1
 
-        assert log_proba.shape == torch.Size([self.n_learnable_neurons]), \
-            'Wrong log_probability shape, got: ' + str(log_proba.shape) + ', expected: ' + str(torch.Size([self.n_learnable_neurons]))
+        return log_proba
 
 
-        ### Compute gradients
-        if self.mode != 'test':
-            self.gradients = self.compute_gradients(self.spiking_history[self.learnable_neurons, -1], self.potential,
-                                                    self.compute_ff_trace(self.spiking_history[:, :-1]),
-                                                    self.compute_fb_trace(self.spiking_history[:, :-1]))
+    def forward_numba(self, input_signal, compute_logproba=True, compute_gradients=True):
+        # The buffers are passed as NumPy views, the spiking history and the feedforward gradient are updated in place without copies.
+        # When no gradients are computed, e.g. in test mode where the feedforward gradient is not allocated, an empty array of the same number of dimensions is passed instead
+        compute_gradients = compute_gradients and (self.mode == 'train')
+        ff_gradient = self.ff_gradient if compute_gradients else torch.zeros([0, 0, 0])
+        self.head, potential, log_proba, ff_gradient, fb_gradient, bias_gradient \
+            = numba_forward_step(self.spiking_history.numpy(), self.head, ff_gradient.numpy(), self.feedforward_weights.numpy(), self.ff_filter_T.numpy(), self.ff_filter_T_past.numpy(),
+                                 self.feedback_weights.numpy(), self.fb_filter_T.numpy(), self.fb_filter_T_past.numpy(), self.filter_indices.numpy(), self.bias.numpy(),
+                                 self.edge_index.numpy(), self.edges_ptr.numpy(), self.learnable_neurons.numpy(), self.visible_neurons.numpy(), self.stochastic_neurons.numpy(),
+                                 self.stochastic_local_neurons.numpy(), input_signal.to(self.spiking_history.dtype).numpy(),
+                                 self.memory_length, compute_gradients, compute_logproba)
 
+        self.potential = torch.from_numpy(potential)
+        if compute_gradients:
+            self.gradients = {'ff_weights': self.ff_gradient, 'fb_weights': torch.from_numpy(fb_gradient), 'bias': torch.from_numpy(bias_gradient)}
 
-        return log_proba
+        return torch.from_numpy(log_proba)
 
 
     ### Getters
@@ -152,105 +307,121 @@ class SNNetwork(torch.nn.Module):
 
 
     def get_history(self):
-        return self.spiking_history
+        # Spiking history ordered in time, the last column holds the spikes of the last timestep
+        return torch.roll(self.spiking_history, self.memory_length - 1 - self.head, -1)
+
+
+    def get_spikes(self):
+        return self.spiking_history[..., self.head]
+
+
+    def get_state(self):
+        # State of the network allocated by set_batch_size, including the spikes recorded and not yet pulled, which can be restored with set_state
+        return {'batch_size': self.batch_size, 'spiking_history': self.spiking_history, 'head': self.head, 'potential': self.potential,
+                'spike_record': self.spike_record, 'rec_head': self.rec_head}
+
+
+    def pull_recording_buffer(self):
+        # Returns the spikes recorded since the last call, ordered in time, in a single transfer to the host.
+        # If more than record_length timesteps were run, only the last record_length are returned
+        if self.rec_head <= self.record_length:
+            record = self.spike_record[..., :self.rec_head]
+        else:
+            record = torch.roll(self.spike_record, - (self.rec_head % self.record_length), -1)
+        self.rec_head = 0
+        return record.to('cpu', copy=True)
 
 
     ### Setters
     def reset_internal_state(self):
-        self.spiking_history = torch.zeros([self.n_neurons, 1])
-        self.potential = torch.zeros(self.potential.shape)
+        self.spiking_history.zero_()
+        self.head = 0
+        self.potential = torch.zeros(self.potential.shape, device=self.device)
+        return
+
+
+    def set_state(self, state):
+        # Restores a state returned by get_state, the buffers are reused without copy
+        self.batch_size = state['batch_size']
+        self.spiking_history = state['spiking_history']
+        self.head = state['head']
+        self.potential = state['potential']
+        self.spike_record = state['spike_record']
+        self.rec_head = state['rec_head']
+        return
+
+
+    def set_batch_size(self, batch_size):
+        # Allocates the state of the network for batch_size trajectories, or for a single trajectory without batch dimension if batch_size is None
+        self.batch_size = batch_size
+        batch_shape = [] if batch_size is None else [batch_size]
+
+        self.spiking_history = torch.zeros(batch_shape + [self.n_neurons, self.memory_length], device=self.device)
+        self.head = 0
+        self.potential = torch.zeros(batch_shape + [self.n_learnable_neurons], device=self.device)
+
+        # Gradients are only computed in train mode, a large test batch does not allocate them
+        if self.mode == 'train':
+            self.ff_gradient = torch.zeros(batch_shape + list(self.feedforward_weights.shape), device=self.device)
+            self.gradients = {'ff_weights': self.ff_gradient,
+                              'fb_weights': torch.zeros(batch_shape + list(self.feedback_weights.shape), device=self.device),
+                              'bias': torch.zeros(batch_shape + list(self.bias.shape), device=self.device)}
+
+        self.spike_record = torch.zeros(batch_shape + [self.n_neurons, self.record_length], device=self.device)
+        self.rec_head = 0
         return
 
 
     def reset_weights(self):
-        self.feedforward_weights = self.weights_magnitude * (torch.rand(self.feedforward_weights.shape) * 2 - 1) * self.feedforward_mask
-        self.feedback_weights = self.weights_magnitude * (torch.rand(self.feedback_weights.shape) * 2 - 1)
-        self.bias = self.weights_magnitude * (torch.rand(self.bias.shape) * 2 - 1)
+        self.feedforward_weights.zero_()
+        self.feedforward_weights[self.edge_index[0], self.edge_index[1]] = torch.empty([self.n_edges, self.n_basis_feedforward], device=self.device).uniform_(-self.weights_magnitude, self.weights_magnitude)
+        self.feedback_weights.uniform_(-self.weights_magnitude, self.weights_magnitude)
+        self.bias.uniform_(-self.weights_magnitude, self.weights_magnitude)
+        if self.mode == 'test':
+            self.feedforward_weights_test = self.feedforward_weights.detach().to(self.test_dtype)
         return
 
 
     def set_ff_weights(self, new_weights):
         assert new_weights.shape == self.feedforward_weights.shape, 'Wrong shape, got ' + str(new_weights.shape) + ', expected' + str(self.feedforward_weights.shape)
-        self.feedforward_weights = new_weights
+        self.feedforward_weights.data = new_weights.to(self.device) * self.topology
+        if self.mode == 'test':
+            self.feedforward_weights_test = self.feedforward_weights.detach().to(self.test_dtype)
         return
 
 
     def set_fb_weights(self, new_weights):
         assert new_weights.shape == self.feedback_weights.shape, 'Wrong shape, got ' + str(new_weights.shape) + ', expected' + str(self.feedback_weights.shape)
-        self.feedback_weights = new_weights
+        self.feedback_weights.data = new_weights.to(self.device)
         return
 
 
     def set_bias(self, new_bias):
         assert new_bias.shape == self.bias.shape, 'Wrong shape, got ' + str(new_bias.shape) + ', expected' + str(self.bias.shape)
-        self.bias = new_bias
+        self.bias.data = new_bias.to(self.device)
         return
 
 
     def set_mode(self, mode):
+        # Stochastic neurons are the neurons sampled from their spiking probability, their local indices index the learnable neurons
         if mode == 'train':
             self.visible_neurons = torch.cat((self.input_neurons, self.output_neurons))
+            self.stochastic_neurons = self.hidden_neurons
             self.mode = 'train'
         elif mode == 'test':
             self.visible_neurons = self.input_neurons
+            self.stochastic_neurons = torch.cat((self.hidden_neurons, self.output_neurons))
             self.mode = 'test'
+            # Weights are updated in place during training, their copy used for test is refreshed when entering test mode.
+            # The copy is detached so that it stays a buffer, even when test_dtype is the dtype of the weights and .to returns the parameter itself
+            self.feedforward_weights_test = self.feedforward_weights.detach().to(self.test_dtype)
         else:
             print('Mode should be one of "train" or "test"')
             raise AttributeError
+        self.stochastic_local_neurons = self.stochastic_neurons - self.n_non_learnable_neurons
         return
 
 
-    ### Computations
-    def compute_ff_trace(self, spikes):
-        return torch.matmul(spikes.flip(-1), self.feedforward_filter[:, :spikes.shape[-1]].transpose(0, 1))
-
-
-    def compute_fb_trace(self, spikes):
-        return torch.matmul(spikes.flip(-1), self.feedback_filter[:, :spikes.shape[-1]].transpose(0, 1))
-
-
-    def compute_ff_potential(self):
-        return torch.sum(self.feedforward_weights * self.compute_ff_trace(self.spiking_history) * self.feedforward_mask, dim=(-1, -2))
-
-
-    def compute_fb_potential(self):
-        return torch.sum(self.feedback_weights * self.compute_fb_trace(self.spiking_history)[self.learnable_neurons, :], dim=(-1))
-
-
-    def generate_spikes(self, spiking_history, neurons_group):
-        spiking_history[neurons_group, -1] = torch.bernoulli(torch.sigmoid(self.potential[neurons_group - self.n_non_learnable_neurons]))
-        return spiking_history
-
-
-    def update_spiking_history(self, input_signal):
-        spiking_history = torch.cat((self.spiking_history[:, - self.memory_length + 1:],
-                                          torch.zeros([self.n_neurons, 1])), dim=-1)
-        spiking_history[self.visible_neurons, -1] = input_signal
-
-        if self.n_hidden_neurons > 0:
-            spiking_history = self.generate_spikes(spiking_history, self.hidden_neurons)
-        if self.mode == 'test':
-            spiking_history = self.generate_spikes(spiking_history, self.output_neurons)
-
-        return spiking_history
-
-
-    def compute_gradients(self, spikes, potential, feedforward_trace, feedback_trace):
-        bias_gradient = spikes - torch.sigmoid(potential)
-        assert bias_gradient.shape == self.bias.shape, "Wrong bias gradient shape"
-
-        ff_gradient = feedforward_trace.unsqueeze(0).repeat(self.n_learnable_neurons, 1, 1) \
-                      * bias_gradient.unsqueeze(1).repeat(1, self.n_neurons).unsqueeze(2).repeat(1, 1, self.n_basis_feedforward) \
-                      * self.feedforward_mask
-        assert ff_gradient.shape == self.feedforward_weights.shape, "Wrong feedforward weights gradient shape"
-
-        fb_gradient = feedback_trace[self.learnable_neurons, :] * bias_gradient.unsqueeze(1).repeat(1, self.n_basis_feedback)
-        assert fb_gradient.shape == self.feedback_weights.shape, "Wrong feedback weights gradient shape"
-
-        return {'ff_weights': ff_gradient, 'fb_weights': fb_gradient, 'bias': bias_gradient}
-
-
-
     ### Misc
     def save(self, path=None):
         if path is None and self.save_path is not None:
@@ -260,10 +431,12 @@ class SNNetwork(torch.nn.Module):
         else:
             raise FileNotFoundError
 
+        # Weights are stored as chunked arrays compressed with Blosc, the feedforward weights are mostly zeros outside of the topology
+        hdf5_filters = tables.Filters(complevel=5, complib='blosc')
         hdf5_file = tables.open_file(save_path, mode='w')
-        weights_ff = hdf5_file.create_array(hdf5_file.root, 'ff_weights', self.feedforward_weights.data.numpy())
-        weights_fb = hdf5_file.create_array(hdf5_file.root, 'fb_weights', self.feedback_weights.data.numpy())
-        bias = hdf5_file.create_array(hdf5_file.root, 'bias', self.feedforward_weights.data.numpy())
+        weights_ff = hdf5_file.create_carray(hdf5_file.root, 'ff_weights', obj=self.feedforward_weights.detach().cpu().numpy(), filters=hdf5_filters)
+        weights_fb = hdf5_file.create_carray(hdf5_file.root, 'fb_weights', obj=self.feedback_weights.detach().cpu().numpy(), filters=hdf5_filters)
+        bias = hdf5_file.create_carray(hdf5_file.root, 'bias', obj=self.bias.detach().cpu().numpy(), filters=hdf5_filters)
         hdf5_file.close()
         return
 
@@ -0,0 +1,108 @@
+import numpy as np
+from numba import njit, prange
+
+''''
+Numba implementation of the per-timestep computations of SNNetwork, used by SNNetwork(use_numba=True) on CPU.
+For small networks the time of a forward pass is dominated by the dispatch of many small PyTorch operations,
+these functions work directly on NumPy views of the buffers of the network instead.
+'''
+
+
+@njit(cache=True, fastmath=True)
+def compute_trace(spiking_history, filter_T, indices):
+    # Same as _compute_trace in SNN.py: indices gives the row of filter_T to apply to each column of the circular spiking history.
+    # Spikes are binary, so only the non-zero entries of the history are accumulated
+    n_neurons, memory_length = spiking_history.shape
+    n_basis = filter_T.shape[1]
+    trace = np.zeros((n_neurons, n_basis), dtype=filter_T.dtype)
+    for j in range(n_neurons):
+        for t in range(memory_length):
+            if spiking_history[j, t] != 0:
+                for k in range(n_basis):
+                    trace[j, k] += spiking_history[j, t] * filter_T[indices[t], k]
+    return trace
+
+
+@njit(cache=True, fastmath=True)
+def softplus(x):
+    # Numerically stable log(1 + exp(x))
+    return max(x, 0.) + np.log1p(np.exp(- abs(x)))
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def forward_step(spiking_history, head, ff_gradient, ff_weights, ff_filter_T, ff_filter_T_past, fb_weights, fb_filter_T, fb_filter_T_past, filter_indices, bias, edge_index,
+                 edges_ptr, learnable_idx, visible_idx, stochastic_idx, stochastic_local_idx, input_signal, memory_length, mode_train,
+                 compute_logproba):
+    # Mirrors _forward_step in SNN.py for a single trajectory, spiking_history is updated in place.
+    # In train mode, ff_gradient is the feedforward gradient buffer of the network, only written along the edges and zero elsewhere
+    # edges_ptr[i]:edges_ptr[i + 1] are the edges of the incoming connections of learnable neuron i, it is computed once by SNNetwork
+    n_learnable = bias.shape[0]
+    n_neurons = spiking_history.shape[0]
+    n_edges = edge_index.shape[1]
+    n_basis_ff = ff_weights.shape[2]
+    n_basis_fb = fb_weights.shape[1]
+
+    ### Compute potential
+    ff_trace = compute_trace(spiking_history, ff_filter_T, filter_indices[head])
+    fb_trace = compute_trace(spiking_history, fb_filter_T, filter_indices[head])
+
+    potential = np.empty(n_learnable, dtype=bias.dtype)
+    sig = np.empty(n_learnable, dtype=bias.dtype)
+    for i in prange(n_learnable):
+        p = bias[i]
+        for e in range(edges_ptr[i], edges_ptr[i + 1]):
+            j = edge_index[1, e]
+            for k in range(n_basis_ff):
+                p += ff_weights[i, j, k] * ff_trace[j, k]
+        for k in range(n_basis_fb):
+            p += fb_weights[i, k] * fb_trace[learnable_idx[i], k]
+        potential[i] = p
+        sig[i] = 1. / (1. + np.exp(-p))
+
+    ### Update spiking history
+    head = (head + 1) % memory_length
+    for j in range(n_neurons):
+        spiking_history[j, head] = 0.
+    for v in range(visible_idx.shape[0]):
+        spiking_history[visible_idx[v], head] = input_signal[v]
+
+    for h in range(stochastic_idx.shape[0]):
+        spiking_history[stochastic_idx[h], head] = 1. if np.random.random() < sig[stochastic_local_idx[h]] else 0.
+
+    ### Compute log-probabilities
+    spikes = np.empty(n_learnable, dtype=bias.dtype)
+    for i in range(n_learnable):
+        spikes[i] = spiking_history[learnable_idx[i], head]
+
+    if compute_logproba:
+        log_proba = np.empty(n_learnable, dtype=bias.dtype)
+        for i in range(n_learnable):
+            # log(sigmoid(u)) = -softplus(-u) and log(1 - sigmoid(u)) = -softplus(u)
+            log_proba[i] = - spikes[i] * softplus(- potential[i]) - (1 - spikes[i]) * softplus(potential[i])
+    else:
+        log_proba = np.zeros(0, dtype=bias.dtype)
+
+    ### Compute gradients
+    if mode_train:
+        bias_gradient = spikes - sig
+
+        past = filter_indices[(head + memory_length - 1) % memory_length]
+        ff_trace = compute_trace(spiking_history, ff_filter_T_past, past)
+        fb_trace = compute_trace(spiking_history, fb_filter_T_past, past)
+
+        for e in prange(n_edges):
+            i = edge_index[0, e]
+            j = edge_index[1, e]
+            for k in range(n_basis_ff):
+                ff_gradient[i, j, k] = ff_trace[j, k] * bias_gradient[i]
+
+        fb_gradient = np.empty(fb_weights.shape, dtype=fb_weights.dtype)
+        for i in prange(n_learnable):
+            for k in range(n_basis_fb):
+                fb_gradient[i, k] = fb_trace[learnable_idx[i], k] * bias_gradient[i]
+    else:
+        # Gradients are not needed during test, or when the caller only needs the spikes
+        bias_gradient = np.zeros(0, dtype=bias.dtype)
+        fb_gradient = np.zeros((0, 0), dtype=fb_weights.dtype)
+
+    return head, potential, log_proba, ff_gradient, fb_gradient, bias_gradient
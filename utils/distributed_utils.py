@@ -29,10 +29,10 @@ def init_training(rank, num_nodes, nodes_group, dataset, eta, epochs, net_parame
     # - distributes the samples among workers
     if rank == 0:
         # Initializing an aggregation list for future weights collection
-        weights_list = [[torch.zeros(network.feedforward_weights.shape, dtype=torch.float) for _ in range(num_nodes)],
-                        [torch.zeros(network.feedback_weights.shape, dtype=torch.float) for _ in range(num_nodes)],
-                        [torch.zeros(network.bias.shape, dtype=torch.float) for _ in range(num_nodes)],
-                        [torch.zeros(1, dtype=torch.float) for _ in range(num_nodes)]]
+        weights_list = [[torch.zeros(network.feedforward_weights.shape, dtype=torch.float, device=network.device) for _ in range(num_nodes)],
+                        [torch.zeros(network.feedback_weights.shape, dtype=torch.float, device=network.device) for _ in range(num_nodes)],
+                        [torch.zeros(network.bias.shape, dtype=torch.float, device=network.device) for _ in range(num_nodes)],
+                        [torch.zeros(1, dtype=torch.float, device=network.device) for _ in range(num_nodes)]]
     else:
         weights_list = []
 
@@ -126,9 +126,9 @@ def feedforward_sampling_accum_gradients(network, training_sequence, et, ls, gra
 
     # Accumulate learning signal
     ls += torch.sum(log_proba[network.output_neurons - network.n_non_learnable_neurons]) / network.n_learnable_neurons \
-          - alpha*torch.sum(network.spiking_history[network.hidden_neurons, -1]
+          - alpha*torch.sum(network.get_spikes()[network.hidden_neurons]
           * torch.log(1e-07 + torch.sigmoid(network.potential[network.hidden_neurons - network.n_non_learnable_neurons]) / r)
-          + (1 - network.spiking_history[network.hidden_neurons, -1])
+          + (1 - network.get_spikes()[network.hidden_neurons])
           * torch.log(1e-07 + (1. - torch.sigmoid(network.potential[network.hidden_neurons - network.n_non_learnable_neurons])) / (1 - r))) / network.n_learnable_neurons
 
     # Accumulate eligibility trace
@@ -174,7 +174,7 @@ def global_update_subset(nodes, rank, network, weights_list, gradients_accum, n_
                 dist.gather(tensor=network.get_parameters()[parameter].data, gather_list=weights_list[j], dst=0, group=nodes)
 
                 indices_received = torch.bincount(torch.nonzero(torch.sum(torch.stack(weights_list[j][1:]), dim=(1, 2)))[:, 1])
-                multiples = torch.zeros(network.n_basis_feedforward)  # indices of weights transmitted by two devices at once: those will be averaged
+                multiples = torch.zeros(network.n_basis_feedforward, device=network.device)  # indices of weights transmitted by two devices at once: those will be averaged
                 multiples[:len(indices_received)] = indices_received
                 multiples[multiples == 0] = 1
 
@@ -188,3 +188,27 @@ def global_update_subset(nodes, rank, network, weights_list, gradients_accum, n_
                 dist.gather(tensor=network.get_parameters()[parameter].data, gather_list=weights_list[j], dst=0, group=nodes)
                 network.get_parameters()[parameter].data = torch.mean(torch.stack(weights_list[j][1:]), dim=0)
         dist.broadcast(network.get_parameters()[parameter], 0, group=nodes)
+
+
+def parallel_forward(networks, input_signals):
+    """"
+    Runs one forward pass for each of several independent networks, e.g. clients simulated in the same process.
+    On GPU, the passes are launched on the CUDA stream of each network so that their kernels can overlap, the Python calls themselves run one after the other.
+    On CPU, the passes are run in sequence.
+    """
+    if all(network.device.type == 'cuda' for network in networks):
+        main_stream = torch.cuda.current_stream()
+
+        log_probas = []
+        for network, input_signal in zip(networks, input_signals):
+            # The inputs and weights are produced on the main stream
+            network.stream.wait_stream(main_stream)
+            with torch.cuda.stream(network.stream):
+                log_probas.append(network(input_signal))
+
+        for network in networks:
+            main_stream.wait_stream(network.stream)
+    else:
+        log_probas = [network(input_signal) for network, input_signal in zip(networks, input_signals)]
+
+    return log_probas
@@ -26,7 +26,7 @@ def make_topology(topology_type, n_input_neurons, n_output_neurons, n_hidden_neu
         topology[:n_hidden_neurons, -n_output_neurons:] = 1
         topology[-n_output_neurons:, -n_output_neurons:] = 1
 
-    topology[[i for i in range(n_output_neurons + n_hidden_neurons)], [i + n_input_neurons for i in range(n_output_neurons + n_hidden_neurons)]] = 0
+    topology[torch.arange(n_output_neurons + n_hidden_neurons, dtype=torch.long), torch.arange(n_input_neurons, n_input_neurons + n_output_neurons + n_hidden_neurons, dtype=torch.long)] = 0
 
     assert torch.sum(topology[:, :n_input_neurons]) == (n_input_neurons * (n_hidden_neurons + n_output_neurons))
 
@@ -35,7 +35,7 @@ def make_topology(topology_type, n_input_neurons, n_output_neurons, n_hidden_neu
 
 def make_network_parameters(n_input_neurons, n_output_neurons, n_hidden_neurons, topology_type, density=1, mode='train', weights_magnitude=0.05,
                             n_basis_ff=8, ff_filter=filters.raised_cosine_pillow_08, n_basis_fb=1, fb_filter=filters.raised_cosine_pillow_08,
-                            tau_ff=10, tau_fb=10, mu=1.5, task='supervised'):
+                            tau_ff=10, tau_fb=10, mu=1.5, task='supervised', device='cpu'):
 
     topology = make_topology(topology_type, n_input_neurons, n_output_neurons, n_hidden_neurons, density)
     print(topology[:, n_input_neurons:])
@@ -52,7 +52,8 @@ def make_network_parameters(n_input_neurons, n_output_neurons, n_hidden_neurons,
                           'mu': mu,
                           'weights_magnitude': weights_magnitude,
                           'task': task,
-                          'mode': mode
+                          'mode': mode,
+                          'device': device
                           }
 
     return network_parameters
@@ -60,39 +61,45 @@ def make_network_parameters(n_input_neurons, n_output_neurons, n_hidden_neurons,
 
 def refractory_period(network):
     length = network.memory_length + 1
+    # The zero input is allocated once on the device of the network, and reused at every step
+    inputs = torch.zeros(list(network.spiking_history.shape[:-2]) + [len(network.visible_neurons)], dtype=torch.float, device=network.device)
     for s in range(length):
-        network(torch.zeros([len(network.visible_neurons)], dtype=torch.float))
+        network(inputs, compute_logproba=False, compute_gradients=False)
 
 
-def get_acc_and_loss(network, input_sequence, output_sequence):
+def get_acc_and_loss(network, input_sequence, output_sequence, max_batch_size=128):
     """"
-    Compute loss and accuracy on the indices from the dataset precised as arguments
+    Compute loss and accuracy on the indices from the dataset precised as arguments.
+    The examples are simulated in parallel as batches of at most max_batch_size trajectories sharing the weights of the network
     """
     network.set_mode('test')
-    network.reset_internal_state()
+    # The state of the network, e.g. during training, and the spikes it recorded are restored after the evaluation
+    state = network.get_state()
 
     S_prime = input_sequence.shape[-1]
     epochs = input_sequence.shape[0]
 
-    S = S_prime * epochs
-    outputs = torch.zeros([epochs, network.n_output_neurons, S_prime])
+    outputs = torch.zeros([epochs, network.n_output_neurons, S_prime], device=network.device)
     loss = 0
 
-    rec = torch.zeros([network.n_learnable_neurons, S_prime])
+    for start in range(0, epochs, max_batch_size):
+        end = min(start + max_batch_size, epochs)
 
-    for s in range(S):
-        if s % S_prime == 0:
-            refractory_period(network)
+        # One trajectory per example, each starting from a fresh state
+        network.set_batch_size(end - start)
+        refractory_period(network)
+
+        for s in range(S_prime):
+            log_proba = network(input_sequence[start:end, :, s])
+            loss += torch.sum(log_proba)
+            outputs[start:end, :, s] = network.get_spikes()[:, network.output_neurons]
 
-        log_proba = network(input_sequence[int(s / S_prime), :, s % S_prime])
-        loss += torch.sum(log_proba).numpy()
-        outputs[int(s / S_prime), :, s % S_prime] = network.spiking_history[network.output_neurons, -1]
-        rec[:, s % S_prime] = network.spiking_history[network.learnable_neurons, -1]
+    network.set_state(state)
 
-    predictions = torch.max(torch.sum(outputs, dim=-1), dim=-1).indices
+    predictions = torch.max(torch.sum(outputs, dim=-1), dim=-1).indices.cpu()
     true_classes = torch.max(torch.sum(output_sequence, dim=-1), dim=-1).indices
     acc = float(torch.sum(predictions == true_classes, dtype=torch.float) / len(predictions))
-    return acc, loss
+    return acc, float(loss)
 
 
 def feedforward_sampling(network, example, et, ls, s, S_prime, alpha, r):
@@ -108,9 +115,9 @@ def feedforward_sampling(network, example, et, ls, s, S_prime, alpha, r):
     # Accumulate learning signal
     proba_hidden = torch.sigmoid(network.potential[network.hidden_neurons - network.n_non_learnable_neurons])
     ls += torch.sum(log_proba[network.output_neurons - network.n_non_learnable_neurons]) / network.n_output_neurons \
-          - alpha*torch.sum(network.spiking_history[network.hidden_neurons, -1]
+          - alpha*torch.sum(network.get_spikes()[network.hidden_neurons]
           * torch.log(1e-12 + proba_hidden / r)
-          + (1 - network.spiking_history[network.hidden_neurons, -1]) * torch.log(1e-12 + (1. - proba_hidden) / (1 - r))) / network.n_hidden_neurons
+          + (1 - network.get_spikes()[network.hidden_neurons]) * torch.log(1e-12 + (1. - proba_hidden) / (1 - r))) / network.n_hidden_neurons
 
     # Accumulate eligibility trace
     for parameter in et: